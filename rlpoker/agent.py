@@ -1,6 +1,5 @@
 import tensorflow as tf
-from collections import deque, namedtuple
-import random
+from collections import namedtuple
 import numpy as np
 
 from rlpoker.buffer import Reservoir, CircularBuffer
@@ -11,158 +10,209 @@ NetSizes = namedtuple('NetSizes', ['num_q_hidden', 'q_dim', 'num_policy_hidden',
 
 class Agent:
     def __init__(self, name, input_dim, action_dim, max_replay=200000,
-                 max_supervised=1000000, best_response_lr=0.1,
-                 supervised_lr=0.005, net_sizes=NetSizes(1, 64, 1, 64)):
+                 max_supervised=1000000, best_response_lr=1e-3,
+                 supervised_lr=1e-3, net_sizes=NetSizes(1, 64, 1, 64),
+                 batch_size=128, state_dtype=np.float16,
+                 huber_loss=False):
         # Replay memory is a circular buffer, and supervised learning memory is a reservoir.
-        self.replay_memory = CircularBuffer(max_replay)
-        self.supervised_memory = Reservoir(max_supervised)
+        # The memories store states as state_dtype, and the states are cast to float32 in
+        # the graph.
+        self.replay_memory = CircularBuffer(max_replay, input_dim, state_dtype=state_dtype)
+        self.supervised_memory = Reservoir(max_supervised, input_dim, state_dtype=state_dtype)
 
         self.input_dim = input_dim
         self.action_dim = action_dim
+        self.batch_size = batch_size
+
+        # Callables precompiled with sess.make_callable for self._session, keyed by name.
+        self._session = None
+        self._callables = {}
 
         self.name = name
-        with tf.variable_scope('agent_{}'.format(name)):
+        # We use resource variables, so that the optimizers apply their updates with
+        # the fused ResourceApply kernels.
+        with tf.variable_scope('agent_{}'.format(name), use_resource=True):
+            # Minibatches are sampled from the memories by tf.data pipelines, so
+            # that the next minibatch is prefetched while the current training
+            # step runs and the training steps need no feed_dict. We only
+            # prefetch one minibatch, so that minibatches include recently
+            # appended episodes.
+            replay_batch = self.create_replay_iterator(batch_size).get_next()
+            states, self.action, self.reward, next_states, self.not_terminals = replay_batch
+            states = tf.cast(states, tf.float32)
+            next_states = tf.cast(next_states, tf.float32)
+            supervised_states, self.supervised_action = \
+                self.create_supervised_iterator(batch_size).get_next()
+            supervised_states = tf.cast(supervised_states, tf.float32)
+
             self.q_network = self.create_q_network('current_q', input_dim,
                     action_dim, num_hidden=net_sizes.num_q_hidden,
-                    hidden_dim=net_sizes.q_dim)
+                    hidden_dim=net_sizes.q_dim, default_input=states)
             self.target_q_network = self.create_q_network('target_q',
                     input_dim, action_dim, num_hidden=net_sizes.num_q_hidden,
-                    hidden_dim=net_sizes.q_dim)
+                    hidden_dim=net_sizes.q_dim, default_input=next_states)
             self.policy_network = self.create_policy_network('policy',
                     input_dim, action_dim,
                     num_hidden=net_sizes.num_policy_hidden,
-                    hidden_dim=net_sizes.policy_dim)
+                    hidden_dim=net_sizes.policy_dim,
+                    default_input=supervised_states)
 
-            # Create ops for copying current network to target network. We create a list
+            # Create an op for copying current network to target network. We create a list
             # of the variables in both networks and then create an assign operation that
             # copies the value in the current variable to the corresponding target variable.
+            # The assign operations are grouped so that a single op runs them all.
             current_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES,
                 scope='agent_{}/current_q'.format(self.name))
             target_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES,
                 scope='agent_{}/target_q'.format(self.name))
-            self.update_ops = [t.assign(c) for t, c in zip(target_vars, current_vars)]
+            self.update_target_op = tf.group(*[t.assign(c) for t, c in zip(target_vars, current_vars)],
+                                             name='update_target')
 
             # Set up Q-learning loss functions
-            self.reward = tf.placeholder(tf.float32, shape=[None])
-            self.action = tf.placeholder(tf.int32, shape=[None])
-            one_hot_action = tf.one_hot(self.action, action_dim)
-
             update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS, scope='agent_{}/current_q'.format(self.name))
 
-            q_value = tf.reduce_sum(one_hot_action * self.q_network['output'], axis=1)
-            self.not_terminals = tf.placeholder(tf.float32, shape=[None])
-            next_q = self.reward + self.not_terminals * tf.reduce_max(tf.stop_gradient(
-                self.target_q_network['output']), axis=1)
-            self.q_loss = tf.reduce_mean(tf.square(next_q - q_value))
+            q_value = tf.gather(self.q_network['output'], self.action, batch_dims=1)
+            max_next_q = tf.reduce_max(self.target_q_network['output'], axis=1)
+            next_q = tf.stop_gradient(self.reward + self.not_terminals * max_next_q)
+            if huber_loss:
+                # Both agents share the graph, so keep the loss out of the global LOSSES collection.
+                self.q_loss = tf.losses.huber_loss(next_q, q_value, loss_collection=None)
+            else:
+                self.q_loss = tf.reduce_mean(tf.math.squared_difference(next_q, q_value))
             with tf.control_dependencies(update_ops):
-                self.q_trainer = tf.train.GradientDescentOptimizer(best_response_lr).minimize(self.q_loss)
+                self.q_trainer = tf.train.AdamOptimizer(best_response_lr).minimize(
+                    self.q_loss, colocate_gradients_with_ops=True)
 
-            policy_for_actions = tf.reduce_sum(self.policy_network['output'] * one_hot_action, axis=1)
-            self.policy_loss = tf.reduce_mean(-tf.log(policy_for_actions))
+            self.policy_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=self.supervised_action, logits=self.policy_network['logits']))
             update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS, scope='agent_{}/policy'.format(self.name))
             with tf.control_dependencies(update_ops):
-                self.policy_trainer = tf.train.GradientDescentOptimizer(supervised_lr).minimize(self.policy_loss)
+                self.policy_trainer = tf.train.AdamOptimizer(supervised_lr).minimize(
+                    self.policy_loss, colocate_gradients_with_ops=True)
 
-    def append_replay_memory(self, transitions):
-        for transition in transitions:
-            self.replay_memory.append(transition)
+    def create_replay_iterator(self, batch_size):
+        """Creates an iterator over minibatches sampled from the replay memory.
+
+        Each element is a tuple (states, actions, rewards, next_states,
+        not_terminals) of arrays with leading dimension batch_size.
+        """
+        def generate_minibatches():
+            while True:
+                yield self.replay_memory.sample(batch_size)
+
+        dataset = tf.data.Dataset.from_generator(
+            generate_minibatches,
+            output_types=(self.replay_memory.states.dtype, tf.int32, tf.float32,
+                          self.replay_memory.states.dtype, tf.float32),
+            output_shapes=([None, self.input_dim], [None], [None], [None, self.input_dim], [None]))
+        return dataset.prefetch(1).make_one_shot_iterator()
+
+    def create_supervised_iterator(self, batch_size):
+        """Creates an iterator over minibatches sampled from the supervised
+        memory.
+
+        Each element is a tuple (states, actions) of arrays with leading
+        dimension batch_size.
+        """
+        def generate_minibatches():
+            while True:
+                yield self.supervised_memory.sample(batch_size)
+
+        dataset = tf.data.Dataset.from_generator(
+            generate_minibatches,
+            output_types=(self.supervised_memory.states.dtype, tf.int32),
+            output_shapes=([None, self.input_dim], [None]))
+        return dataset.prefetch(1).make_one_shot_iterator()
+
+    def append_replay_memory(self, states, actions, rewards, next_states, terminals):
+        """Appends a batch of transitions to the replay memory. Each argument
+        is an array with one row per transition.
+        """
+        if len(actions) == 0:
+            return
+        self.replay_memory.append_batch(states, actions, rewards, next_states, terminals)
 
-    def append_supervised_memory(self, state_action_pairs):
-        for state_action_pair in state_action_pairs:
-            self.supervised_memory.append(state_action_pair)
+    def append_supervised_memory(self, states, actions):
+        """Appends a batch of state-action pairs to the supervised memory. Each
+        argument is an array with one row per pair.
+        """
+        if len(actions) == 0:
+            return
+        self.supervised_memory.append_batch(states, actions)
 
     # Get the output of the q network for the given state
     def predict_q(self, sess, state):
+        state = np.asarray(state, dtype=np.float32)
         assert len(state.shape) == 2
         assert state.shape[1] == self.input_dim
-        return sess.run(self.q_network['output'], feed_dict={
-            self.q_network['input']: state,
-            self.q_network['training']: False
-        })
+        predict_q = self.get_callable(sess, 'predict_q', self.q_network['output'],
+                                      feed_list=[self.q_network['input']])
+        return predict_q(state)
 
-    # Get the output of the q network for the given state
+    # Get the output of the policy network for the given state
     def predict_policy(self, sess, state):
+        state = np.asarray(state, dtype=np.float32)
         assert len(state.shape) == 2
         assert state.shape[1] == self.input_dim
-        return sess.run(self.policy_network['output'], feed_dict={
-            self.policy_network['input']: state,
-            self.policy_network['training']: False
-        })
+        predict_policy = self.get_callable(sess, 'predict_policy', self.policy_network['output'],
+                                           feed_list=[self.policy_network['input']])
+        return predict_policy(state)
 
     def update_target_network(self, sess):
         # Copy current q_network parameters to target_q_network
-        sess.run(self.update_ops)
-
-    def train_q_network(self, sess, batch_size):
-        # Sample a minibatch from the replay memory
-        minibatch = self.replay_memory.sample(batch_size)
-
-        states = np.array([d['state'] for d in minibatch])
-        actions = np.array([d['action'] for d in minibatch])
-        next_states = np.array([d['next_state'] for d in minibatch])
-        rewards = np.array([d['reward'] for d in minibatch])
-        terminals = np.array([d['terminal'] for d in minibatch])
-
-        not_terminals = np.array([not t for t in terminals]).astype('float32')
-
-        q_loss, _ = sess.run([self.q_loss, self.q_trainer], feed_dict={
-            self.reward: rewards,
-            self.action: actions,
-            self.not_terminals: not_terminals,
-            self.q_network['input']: states,
-            self.target_q_network['input']: next_states,
-            self.q_network['training']: True,
-            self.target_q_network['training']: True
-        })
+        self.get_callable(sess, 'update_target', self.update_target_op)()
+
+    def get_callable(self, sess, name, fetches, feed_list=None):
+        """Returns a callable that runs fetches in sess, feeding its arguments
+        to feed_list. The callable is created with sess.make_callable the first
+        time it is requested, and cached under name afterwards. Only the
+        callables for the most recent session are cached: passing a different
+        session releases the cached callables, and with them the old session.
+        """
+        if sess is not self._session:
+            self._session = sess
+            self._callables = {}
+        if name not in self._callables:
+            self._callables[name] = sess.make_callable(fetches, feed_list=feed_list)
+        return self._callables[name]
+
+    def train_q_network(self, sess):
+        # The minibatch is sampled from the replay memory by the input pipeline.
+        train_q = self.get_callable(sess, 'train_q', [self.q_loss, self.q_trainer], feed_list=[
+            self.q_network['training'],
+            self.target_q_network['training']
+        ])
+        q_loss, _ = train_q(True, True)
         return q_loss
 
-    def train_policy_network(self, sess, batch_size):
-        # Sample a minibatch from the supervised memory
-        minibatch = self.supervised_memory.sample(batch_size)
-
-        states = np.array([d['state'] for d in minibatch])
-        actions = np.array([d['action'] for d in minibatch])
-
-        policy_loss, _ = sess.run([self.policy_loss, self.policy_trainer], feed_dict={
-            self.policy_network['input']: states,
-            self.action: actions,
-            self.policy_network['training']: True
-        })
+    def train_policy_network(self, sess):
+        # The minibatch is sampled from the supervised memory by the input pipeline.
+        train_policy = self.get_callable(sess, 'train_policy', [self.policy_loss, self.policy_trainer],
+                                         feed_list=[self.policy_network['training']])
+        policy_loss, _ = train_policy(True)
         return policy_loss
 
     # Create a 2 layer neural network with relu activations on the hidden
-    # layer. The output is the predicted q-value of an action.
-    def create_q_network(self, scope, input_dim, action_dim, num_hidden=1, hidden_dim=64, dropout_rate=None):
+    # layer. The output is the predicted q-value of an action. If default_input
+    # is given, then the network reads from it unless the input is fed.
+    def create_q_network(self, scope, input_dim, action_dim, num_hidden=1, hidden_dim=64, dropout_rate=None,
+            default_input=None):
         with tf.variable_scope(scope):
-            input_layer = tf.placeholder(tf.float32, shape=[None, input_dim], name='input')
-            training = tf.placeholder(tf.bool, name='training')
-
-            hidden_layer = input_layer
+            input_layer = create_input_layer(input_dim, default_input)
+            training = tf.placeholder_with_default(False, shape=[], name='training')
 
-            for i in range(num_hidden):
-                hidden_layer = tf.layers.dense(hidden_layer, hidden_dim, activation=tf.nn.relu)
-                if dropout_rate:
-                    hidden_layer = tf.layers.dropout(hidden_layer, dropout_rate, training=training)
-                hidden_layer = tf.layers.batch_normalization(hidden_layer, axis=-1, training=training)
-
-            output_layer = tf.layers.dense(hidden_layer, action_dim)
+            output_layer = create_layers(input_layer, training, action_dim, num_hidden, hidden_dim, dropout_rate)
         return {'input': input_layer, 'output': output_layer, 'training': training}
 
     def create_policy_network(self, scope, input_dim, action_dim, num_hidden=1, hidden_dim=64,
-            dropout_rate=None):
+            dropout_rate=None, default_input=None):
         with tf.variable_scope(scope):
-            input_layer = tf.placeholder(tf.float32, shape=[None, input_dim])
-            training = tf.placeholder(tf.bool, name='training')
-
-            hidden_layer = input_layer
-            for i in range(num_hidden):
-                hidden_layer = tf.layers.dense(hidden_layer, hidden_dim, activation=tf.nn.relu)
-                if dropout_rate:
-                    hidden_layer = tf.layers.dropout(hidden_layer, dropout_rate, training=training)
-                hidden_layer = tf.layers.batch_normalization(hidden_layer, axis=-1, training=training)
+            input_layer = create_input_layer(input_dim, default_input)
+            training = tf.placeholder_with_default(False, shape=[], name='training')
 
-            output_layer = tf.layers.dense(hidden_layer, action_dim, activation=tf.nn.softmax)
-        return {'input': input_layer, 'output': output_layer, 'training': training}
+            logits = create_layers(input_layer, training, action_dim, num_hidden, hidden_dim, dropout_rate)
+            output_layer = tf.nn.softmax(logits)
+        return {'input': input_layer, 'output': output_layer, 'logits': logits, 'training': training}
 
     def get_strategy(self, sess, states):
         """Returns a strategy for an agent. This is a mapping from
@@ -174,9 +224,58 @@ class Agent:
             states: dict. This is a dictionary with keys the information set
                 ids and values the vectors to input to the network.
         """
-        strategy = dict()
-        for info_set_id, state in states.items():
-            policy = self.predict_policy(sess, np.array([state])).ravel()
-            strategy[info_set_id] = {i: policy[i] for i in range(len(policy))}
+        info_set_ids = list(states.keys())
+        state_matrix = np.stack([states[info_set_id] for info_set_id in info_set_ids]).astype(np.float32, copy=False)
+        return self.get_strategy_from_matrix(sess, info_set_ids, state_matrix)
+
+    def get_strategy_from_matrix(self, sess, info_set_ids, state_matrix):
+        """Returns a strategy for an agent, as in get_strategy, given the
+        state vectors stacked into a matrix. Callers that compute the strategy
+        repeatedly can stack the vectors once and reuse the matrix.
 
-        return strategy
+        Args:
+            sess: tensorflow session.
+            info_set_ids: list. The information set ids.
+            state_matrix: array of shape (len(info_set_ids), input_dim). Row i
+                is the vector to input to the network for info_set_ids[i].
+        """
+        # Compute the policies for all the information sets in one batch.
+        policies = self.predict_policy(sess, state_matrix)
+
+        actions = range(self.action_dim)
+        return {info_set_id: {i: policy[i] for i in actions}
+                for info_set_id, policy in zip(info_set_ids, policies)}
+
+
+def create_input_layer(input_dim, default_input=None):
+    """Creates the input layer of a network. This is a placeholder, which
+    defaults to default_input if given.
+    """
+    if default_input is None:
+        return tf.placeholder(tf.float32, shape=[None, input_dim], name='input')
+    return tf.placeholder_with_default(default_input, shape=[None, input_dim], name='input')
+
+
+def create_layers(input_layer, training, output_dim, num_hidden, hidden_dim, dropout_rate=None):
+    """Creates the hidden layers and the linear output layer of a network.
+    Each hidden layer is a dense layer with relu activations and He
+    initialisation, followed by dropout if dropout_rate is given, and batch
+    normalisation.
+
+    The q network and policy network both use this, but each creates its own
+    weights: in NFSP they approximate the best response and the average
+    strategy, and are trained on different memories.
+    """
+    # Compile the layers with XLA, so that the bias, relu and batch
+    # normalisation ops between the matmuls are fused into fewer kernels.
+    with tf.xla.experimental.jit_scope():
+        hidden_layer = input_layer
+        for i in range(num_hidden):
+            hidden_layer = tf.keras.layers.Dense(hidden_dim, activation='relu',
+                                                 kernel_initializer=tf.keras.initializers.he_uniform(),
+                                                 dtype=tf.float32)(hidden_layer)
+            if dropout_rate:
+                hidden_layer = tf.layers.dropout(hidden_layer, dropout_rate, training=training)
+            hidden_layer = tf.layers.batch_normalization(hidden_layer, axis=-1, training=training)
+
+        return tf.keras.layers.Dense(output_dim, dtype=tf.float32)(hidden_layer)
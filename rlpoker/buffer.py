@@ -1,71 +1,164 @@
-import abc
-import random
-from collections import deque
+"""Memories for the agents. Each memory stores its items field by field in preallocated numpy arrays, so that
+appending and sampling are vectorised. The states can be stored with a smaller dtype than float32 to save memory,
+e.g. float16 or uint8 for indicator vectors.
+
+Appending and sampling hold a lock on the memory, since the agent's input pipelines sample on a background thread
+while the rollouts append.
+"""
+import threading
 
 import numpy as np
 
 
-class Buffer:
+def sample_indices(size, n, replace=True):
+    """Samples n indices uniformly from range(size).
+
+    Sampling without replacement permutes all size indices, so sampling with replacement is the default, and is
+    O(n) regardless of size.
+    """
+    assert size > 0, "Cannot sample from an empty buffer."
+    if replace:
+        return np.random.randint(0, size, n)
+    return np.random.choice(size, n, replace=False)
+
+
+class Reservoir:
+    """Implements a reservoir of state-action pairs with maximum length. The reservoir holds a uniform sample of all
+    the pairs appended to it.
+    """
 
-    def __init__(self, maxlen=None):
+    def __init__(self, maxlen, state_dim, action_dtype=np.int32, state_dtype=np.float32):
         self.maxlen = maxlen
-        self.buffer = deque(maxlen=maxlen)
+        self.states = np.empty((maxlen, state_dim), dtype=state_dtype)
+        self.actions = np.empty(maxlen, dtype=action_dtype)
+
+        # The number of pairs appended so far, and the number of pairs stored.
+        self.i = 0
+        self.size = 0
 
-    @abc.abstractmethod
-    def append(self, item):
-        """Adds the item to the buffer."""
+        self._lock = threading.Lock()
+
+    def append(self, state, action):
+        """Appends a single state-action pair. See append_batch.
+        """
+        self.append_batch(np.asarray([state]), np.asarray([action]))
+
+    def append_batch(self, states, actions):
+        """Implements reservoir sampling on a batch of state-action pairs.
+
+        Let the pair be the ith pair. If i <= self.maxlen, then we keep the pair. Otherwise, we keep the new pair with
+        probability self.maxlen / i and otherwise discard it. If we keep the new pair, we randomly choose an old pair
+        to discard. The decisions for the whole batch are made at once.
+
+        Args:
+            states: array of shape (n, state_dim).
+            actions: array of shape (n,).
+        """
+        with self._lock:
+            n = len(actions)
+
+            # Fill any free space first.
+            num_fill = min(n, self.maxlen - self.size)
+            self.states[self.size:self.size + num_fill] = states[:num_fill]
+            self.actions[self.size:self.size + num_fill] = actions[:num_fill]
+            self.size += num_fill
+
+            # The remaining pairs are pairs i + num_fill + 1, ..., i + n, and we keep the ith pair with probability
+            # self.maxlen / i. If two kept pairs replace the same index, numpy assigns the later one, as if they were
+            # appended one by one.
+            counts = self.i + np.arange(num_fill + 1, n + 1)
+            keep = np.random.rand(n - num_fill) < self.maxlen / counts
+            discard_idx = np.random.randint(0, self.maxlen, np.count_nonzero(keep))
+            self.states[discard_idx] = states[num_fill:][keep]
+            self.actions[discard_idx] = actions[num_fill:][keep]
+
+            self.i += n
 
     def sample(self, n: int, replace: bool=True):
-        """Samples n items uniformly from the buffer.
+        """Samples n state-action pairs uniformly from the reservoir.
 
         Args:
-            n: int. Number of items to sample.
+            n: int. Number of pairs to sample.
             replace: bool. Whether to sample with or without replacement.
+
+        Returns:
+            tuple. Arrays (states, actions), each with leading dimension n.
         """
-        indices = list(np.random.choice(self.__len__(), n, replace=replace))
-        return [self.buffer[i] for i in indices]
+        with self._lock:
+            idx = sample_indices(self.size, n, replace)
+            return self.states[idx], self.actions[idx]
 
     def __len__(self):
-        return len(self.buffer)
+        return self.size
 
+    def __repr__(self):
+        return "Reservoir(maxlen={}, size={})".format(self.maxlen, self.size)
 
-class Reservoir(Buffer):
-    def __init__(self, maxlen):
-        self.i = 0
 
-        super().__init__(maxlen)
+class CircularBuffer:
+    """Implements a circular buffer of transitions with maximum length. Once the buffer is full, each new
+    transition overwrites the oldest one.
+    """
+
+    def __init__(self, maxlen, state_dim, action_dtype=np.int32, state_dtype=np.float32):
+        self.maxlen = maxlen
+        self.states = np.empty((maxlen, state_dim), dtype=state_dtype)
+        self.actions = np.empty(maxlen, dtype=action_dtype)
+        self.rewards = np.empty(maxlen, dtype=np.float32)
+        self.next_states = np.empty_like(self.states)
+        self.not_terminals = np.empty(maxlen, dtype=np.float32)
+
+        # The index to write the next transition to, and the number of transitions stored.
+        self.pos = 0
+        self.size = 0
 
-    def append(self, item):
-        """Implements reservoir sampling.
+        self._lock = threading.Lock()
 
-        Let the item be the ith item. If i < self.maxlen, then we keep the item. Otherwise, we keep the new item with
-        probability self.maxlen / i and otherwise discard it. If we keep the new item, we randomly choose an old item
-        to discard.
+    def append(self, state, action, reward, next_state, terminal):
+        """Appends a single transition. See append_batch.
         """
-        self.i += 1
-        if self.__len__() < self.maxlen:
-            self.buffer.append(item)
-        else:
-            # With probability self.maxlen / i, replace an existing item with the new item.
-            if np.random.rand() < self.maxlen / self.i:
-                discard_idx = np.random.choice(self.maxlen)
-                self.buffer[discard_idx] = item
+        self.append_batch(np.asarray([state]), np.asarray([action]), np.asarray([reward]),
+                          np.asarray([next_state]), np.asarray([terminal]))
 
-    def __repr__(self):
-        return "Reservoir(buffer={})".format(self.buffer)
+    def append_batch(self, states, actions, rewards, next_states, terminals):
+        """Appends a batch of transitions to the buffer, overwriting the oldest transitions if the buffer is full.
 
+        Args:
+            states: array of shape (n, state_dim).
+            actions: array of shape (n,).
+            rewards: array of shape (n,).
+            next_states: array of shape (n, state_dim).
+            terminals: boolean array of shape (n,).
+        """
+        with self._lock:
+            n = len(actions)
+            idx = (self.pos + np.arange(n)) % self.maxlen
+            self.states[idx] = states
+            self.actions[idx] = actions
+            self.rewards[idx] = rewards
+            self.next_states[idx] = next_states
+            self.not_terminals[idx] = np.logical_not(terminals)
+
+            self.pos = (self.pos + n) % self.maxlen
+            self.size = min(self.size + n, self.maxlen)
 
-class CircularBuffer(Buffer):
-    """Implements a circular buffer with maximum length.
-    """
+    def sample(self, n: int, replace: bool=True):
+        """Samples n transitions uniformly from the buffer.
 
-    def __init__(self, maxlen=None):
-        super().__init__(maxlen)
+        Args:
+            n: int. Number of transitions to sample.
+            replace: bool. Whether to sample with or without replacement.
 
-    def append(self, item):
-        """Appends an item to the buffer.
+        Returns:
+            tuple. Arrays (states, actions, rewards, next_states, not_terminals), each with leading dimension n.
         """
-        self.buffer.append(item)
+        with self._lock:
+            idx = sample_indices(self.size, n, replace)
+            return (self.states[idx], self.actions[idx], self.rewards[idx], self.next_states[idx],
+                    self.not_terminals[idx])
+
+    def __len__(self):
+        return self.size
 
     def __repr__(self):
-        return "CircularBuffer(buffer={})".format(self.buffer)
+        return "CircularBuffer(maxlen={}, size={})".format(self.maxlen, self.size)
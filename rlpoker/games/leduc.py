@@ -312,6 +312,15 @@ class LeducNFSP(NFSPGame):
         lengths = [len(tuple(v)) for v in self._state_vectors.values()]
         assert len(set(lengths)) == 1
         self.state_dim = lengths[0]
+
+        # Also stack the state vectors into a matrix, so that they can be input
+        # to a network in one batch.
+        self._info_set_ids = list(self._state_vectors.keys())
+        self._state_matrix = np.stack(
+            [self._state_vectors[info_set_id] for info_set_id in self._info_set_ids]).astype(np.float32)
+        # The rows of the matrix are the float32 state vectors returned by
+        # summarise, so they can be input to a network without a copy.
+        self._state_rows = dict(zip(self._info_set_ids, self._state_matrix))
         self.action_dim = 3
 
     def summarise(self, node):
@@ -326,11 +335,11 @@ class LeducNFSP(NFSPGame):
         if not is_terminal:
             player = self._player_map[node.player]
             info_set_id = self._game.info_set_ids[node]
-            state_vector = self._state_vectors[info_set_id]
+            state_vector = self._state_rows[info_set_id]
         else:
             player = node.player
             assert player == -1
-            state_vector = np.zeros(self.state_dim)
+            state_vector = np.zeros(self.state_dim, dtype=np.float32)
 
         # Set up available actions as a one-hot vector.
         available_actions = sorted(list(node.children.keys()))
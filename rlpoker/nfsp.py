@@ -46,30 +46,27 @@ def compute_agent_exploitability(agent: Agent, sess: tf.Session, game: NFSPGame)
     Returns:
         float. Exploitability of the agent's strategy.
     """
-    states = game._state_vectors
-    strategy = agent.get_strategy(sess, states)
+    strategy = agent.get_strategy_from_matrix(sess, game._info_set_ids, game._state_matrix)
 
     return compute_exploitability(game._game, strategy)
 
 
 def build_transitions(states, actions, rewards):
-    """Creates a dictionary with keys the players and values a list of transitions for that player. Each transition
-    is a dictionary with keys 'state', 'action', 'reward', 'next_state', 'is_terminal'.
+    """Creates a dictionary with keys the players and values the transitions for that player. The transitions are a
+    tuple of arrays (states, actions, rewards, next_states, terminals), with one row per transition.
     """
-    players = list(rewards.keys())
-    transitions = {player: [] for player in players}
-    for player in players:
+    transitions = {}
+    for player in rewards:
         num_transitions = len(actions[player])
         assert len(states[player]) == num_transitions + 1
-        for i in range(num_transitions):
-            is_terminal = True if i == num_transitions - 1 else False
-            reward = rewards[player] if is_terminal else 0.0
-            transitions[player].append(
-                {'state': states[player][i],
-                 'next_state': states[player][i+1],
-                 'action': actions[player][i],
-                 'reward': reward,
-                 'terminal': is_terminal})
+        player_states = np.array(states[player], dtype=np.float32)
+        # Only the last transition is terminal, and it gets all the reward.
+        terminals = np.arange(num_transitions) == num_transitions - 1
+        transitions[player] = (player_states[:-1],
+                               np.array(actions[player], dtype=np.int32),
+                               np.where(terminals, rewards[player], 0.0).astype(np.float32),
+                               player_states[1:],
+                               terminals)
 
     return transitions
 
@@ -81,10 +78,12 @@ def nfsp(game, hypers: Hyperparameters, train_players=(1, 2), max_train_steps=10
     # Create two agents
     agents = {1: Agent('1', game.state_dim, game.action_dim,
                        best_response_lr=hypers.best_response_lr, supervised_lr=hypers.supervised_lr,
-                       net_sizes=hypers.net_sizes, max_replay=hypers.max_replay, max_supervised=hypers.max_supervised),
+                       net_sizes=hypers.net_sizes, max_replay=hypers.max_replay, max_supervised=hypers.max_supervised,
+                       batch_size=hypers.batch_size),
               2: Agent('2', game.state_dim, game.action_dim,
                        best_response_lr=hypers.best_response_lr, supervised_lr=hypers.supervised_lr,
-                       net_sizes=hypers.net_sizes, max_replay=hypers.max_replay, max_supervised=hypers.max_supervised)}
+                       net_sizes=hypers.net_sizes, max_replay=hypers.max_replay, max_supervised=hypers.max_supervised,
+                       batch_size=hypers.batch_size)}
 
     # Create summary tensors
     summary_names = ['q_loss_1', 'q_loss_2', 'policy_loss_1', 'policy_loss_2', 'exploitability_1',
@@ -114,8 +113,12 @@ def nfsp(game, hypers: Hyperparameters, train_players=(1, 2), max_train_steps=10
     with open(log_file, 'a') as f:
         f.write("Using hyperparameters: {}\n".format(hypers))
 
-    # Create the session and initialise all variables
-    sess = tf.Session()
+    # Create the session and initialise all variables. We turn on XLA JIT
+    # compilation so that chains of elementwise ops, e.g. in the losses, are
+    # fused into single kernels.
+    config = tf.ConfigProto()
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    sess = tf.Session(config=config)
     sess.run(tf.global_variables_initializer())
     tf_train_writer = tf.summary.FileWriter(save_path, graph=sess.graph)
 
@@ -144,7 +147,8 @@ def nfsp(game, hypers: Hyperparameters, train_players=(1, 2), max_train_steps=10
 
         states = {1: [], 2: []}
         actions = {1: [], 2: []}
-        supervised = {1: [], 2: []}
+        supervised_states = {1: [], 2: []}
+        supervised_actions = {1: [], 2: []}
         # Select the strategies
         strategy1 = np.random.choice(['q', 'policy'], p=[hypers.eta, 1.0-hypers.eta])
         strategy2 = np.random.choice(['q', 'policy'], p=[hypers.eta, 1.0-hypers.eta])
@@ -177,16 +181,16 @@ def nfsp(game, hypers: Hyperparameters, train_players=(1, 2), max_train_steps=10
                 if np.random.random() < epsilon:
                     action = np.random.choice(available_actions)
                 else:
-                    q_values = agent.predict_q(sess, np.array([state])).ravel()
-                    for i in range(len(q_values)):
-                        if i not in available_actions:
-                            q_values[i] = -np.inf
+                    q_values = agent.predict_q(sess, state[np.newaxis]).ravel()
+                    unavailable = np.ones(len(q_values), dtype=bool)
+                    unavailable[available_actions] = False
+                    q_values[unavailable] = -np.inf
                     action = np.argmax(q_values)
             else:
                 if verbose:
                     with open(log_file, 'a') as f:
                         f.write("Playing with policy\n")
-                policy = agent.predict_policy(sess, np.array([state])).ravel()
+                policy = agent.predict_policy(sess, state[np.newaxis]).ravel()
                 policy = normalise_policy(policy, available_actions)
 
                 # We first normalise the probabilities to the available
@@ -213,7 +217,8 @@ def nfsp(game, hypers: Hyperparameters, train_players=(1, 2), max_train_steps=10
             # Only add to the supervised learning memory if we were playing our
             # best response strategy.
             if strategy == 'q':
-                supervised[player].append({'state': state, 'action': action})
+                supervised_states[player].append(state)
+                supervised_actions[player].append(action)
 
             # Set the next player and next state
             player = next_player
@@ -246,8 +251,9 @@ def nfsp(game, hypers: Hyperparameters, train_players=(1, 2), max_train_steps=10
                 with open(log_file, 'a') as f:
                     f.write("Adding transitions to player: {}\n".format(player))
                     f.write(str(transitions[player]) + '\n')
-            agents[player].append_replay_memory(transitions[player])
-            agents[player].append_supervised_memory(supervised[player])
+            agents[player].append_replay_memory(*transitions[player])
+            agents[player].append_supervised_memory(np.array(supervised_states[player], dtype=np.float32),
+                                                     np.array(supervised_actions[player], dtype=np.int32))
 
         # Train the Q-networks
         if train_step >= hypers.steps_before_training:
@@ -256,10 +262,10 @@ def nfsp(game, hypers: Hyperparameters, train_players=(1, 2), max_train_steps=10
                 if player not in train_players:
                     continue
                 if train_step % hypers.q_learn_every == 0:
-                    q_loss = agent.train_q_network(sess, hypers.batch_size)
+                    q_loss = agent.train_q_network(sess)
                     q_losses[player].append(q_loss)
                 if train_step % hypers.policy_learn_every == 0:
-                    policy_loss = agent.train_policy_network(sess, hypers.batch_size)
+                    policy_loss = agent.train_policy_network(sess)
                     policy_losses[player].append(policy_loss)
 
                 # Update the target networks
@@ -320,11 +326,10 @@ def nfsp(game, hypers: Hyperparameters, train_players=(1, 2), max_train_steps=10
 
 def normalise_policy(policy, available_actions):
     assert len(policy.shape) == 1
-    one_hot = np.zeros(policy.shape[0], dtype=float)
-    for i in available_actions:
-        one_hot[i] = 1.0
+    available = np.zeros(policy.shape[0], dtype=bool)
+    available[available_actions] = True
 
-    policy *= one_hot
+    policy *= available
 
     return policy / np.sum(policy)
 
@@ -332,8 +337,9 @@ def normalise_policy(policy, available_actions):
 def sample_hypers():
     max_replay = int(np.random.choice([50000, 200000, 400000]))
     max_supervised = int(np.random.choice([200000, 400000, 1000000, 2000000]))
-    best_response_lr = 10.0**(-5 + 5 * np.random.random())
-    supervised_lr = 10.0**(-5 + 5 * np.random.random())
+    # The learning rates are Adam step sizes, so we sample them from [1e-5, 1e-2].
+    best_response_lr = 10.0**(-5 + 3 * np.random.random())
+    supervised_lr = 10.0**(-5 + 3 * np.random.random())
     steps_before_training = int(np.random.randint(1000, 100000))
     eta = np.random.random() * 0.6
     update_target_q_every = int(np.random.choice([200, 300, 1000]))
@@ -434,8 +440,8 @@ class LearningRateSetup(BayesOptSetup):
 
     def domain(self):
         return [
-            {'name': 'log_br_lr', 'type': 'continuous', 'domain': (-5, 0)},
-            {'name': 'log_sl_lr', 'type': 'continuous', 'domain': (-5, 0)}
+            {'name': 'log_br_lr', 'type': 'continuous', 'domain': (-5, -2)},
+            {'name': 'log_sl_lr', 'type': 'continuous', 'domain': (-5, -2)}
         ]
 
 
@@ -509,7 +515,7 @@ if __name__ == '__main__':
         run_bayesian_optimisation(100, objective, bayes_opt_setup)
     else:
         hypers = Hyperparameters(max_replay=200000, max_supervised=1000000,
-                best_response_lr=1e-2, supervised_lr=5e-3,
+                best_response_lr=1e-3, supervised_lr=1e-3,
                 steps_before_training=args.steps_before_training, eta=args.eta,
                 update_target_q_every=300, initial_epsilon=0.1, final_epsilon=0.0,
                 epsilon_steps=10000, batch_size=128, q_learn_every=1,
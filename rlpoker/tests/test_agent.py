@@ -2,6 +2,8 @@ import numpy as np
 import tensorflow as tf
 
 from rlpoker.agent import Agent
+from rlpoker.games.card import get_deck
+from rlpoker.games.leduc import LeducNFSP
 
 
 def test_update_target_network():
@@ -33,3 +35,122 @@ def test_update_target_network():
         })
         np.testing.assert_allclose(predict_q, predict_target_q)
 
+
+
+def test_train_networks():
+    input_dim = 10
+    action_dim = 3
+    num_transitions = 20
+
+    with tf.Graph().as_default():
+        agent = Agent('A', input_dim, action_dim, batch_size=8)
+
+        states = np.random.randn(num_transitions, input_dim)
+        next_states = np.random.randn(num_transitions, input_dim)
+        actions = np.random.randint(action_dim, size=num_transitions)
+        rewards = np.random.randn(num_transitions)
+        terminals = np.random.rand(num_transitions) < 0.5
+        agent.append_replay_memory(states, actions, rewards, next_states, terminals)
+        agent.append_supervised_memory(states, actions)
+
+        q_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='agent_A/current_q')
+        policy_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='agent_A/policy')
+        assert len(q_vars) > 0
+        assert len(policy_vars) > 0
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            agent.update_target_network(sess)
+
+            q_before, policy_before = sess.run([q_vars, policy_vars])
+
+            for i in range(5):
+                q_loss = agent.train_q_network(sess)
+                policy_loss = agent.train_policy_network(sess)
+                assert np.isfinite(q_loss)
+                assert np.isfinite(policy_loss)
+
+            q_after, policy_after = sess.run([q_vars, policy_vars])
+
+    for before, after in zip(q_before + policy_before, q_after + policy_after):
+        assert not np.allclose(before, after)
+
+
+def test_callables_cached_for_latest_session():
+    input_dim = 10
+    action_dim = 3
+
+    with tf.Graph().as_default():
+        agent = Agent('A', input_dim, action_dim)
+        state = np.random.randn(4, input_dim)
+
+        for i in range(3):
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                agent.predict_q(sess, state)
+                agent.predict_q(sess, state)
+                agent.predict_policy(sess, state)
+
+                # Only this session's callables are cached.
+                assert agent._session is sess
+                assert set(agent._callables.keys()) == {'predict_q', 'predict_policy'}
+
+
+def test_get_strategy():
+    game = LeducNFSP(get_deck(num_values=3, num_suits=2))
+    states = game._state_vectors
+
+    with tf.Graph().as_default():
+        agent = Agent('A', game.state_dim, game.action_dim)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+
+            strategy = agent.get_strategy(sess, states)
+            assert set(strategy.keys()) == set(states.keys())
+
+            # Each information set's strategy is the policy for its own state vector.
+            for info_set_id in list(states.keys())[:10]:
+                policy = agent.predict_policy(sess, states[info_set_id][None]).ravel()
+                np.testing.assert_allclose([strategy[info_set_id][i] for i in range(game.action_dim)], policy,
+                                           rtol=1e-5)
+
+            strategy_from_matrix = agent.get_strategy_from_matrix(sess, game._info_set_ids, game._state_matrix)
+
+    assert set(strategy_from_matrix.keys()) == set(strategy.keys())
+    for info_set_id, action_probs in strategy.items():
+        assert set(strategy_from_matrix[info_set_id].keys()) == set(action_probs.keys())
+        for action, prob in action_probs.items():
+            np.testing.assert_allclose(strategy_from_matrix[info_set_id][action], prob, rtol=1e-5)
+
+
+def test_train_q_network_huber_loss():
+    input_dim = 10
+    action_dim = 3
+    num_transitions = 20
+
+    with tf.Graph().as_default():
+        agent = Agent('A', input_dim, action_dim, batch_size=8, huber_loss=True)
+
+        agent.append_replay_memory(np.random.randn(num_transitions, input_dim),
+                                   np.random.randint(action_dim, size=num_transitions),
+                                   np.random.randn(num_transitions),
+                                   np.random.randn(num_transitions, input_dim),
+                                   np.random.rand(num_transitions) < 0.5)
+
+        q_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='agent_A/current_q')
+        assert len(q_vars) > 0
+        assert len(tf.get_collection(tf.GraphKeys.LOSSES)) == 0
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            agent.update_target_network(sess)
+
+            q_before = sess.run(q_vars)
+            for i in range(5):
+                q_loss = agent.train_q_network(sess)
+                assert np.isfinite(q_loss)
+            q_after = sess.run(q_vars)
+
+    for before, after in zip(q_before, q_after):
+        assert not np.allclose(before, after)
@@ -1,39 +1,135 @@
-from collections import deque
+import threading
+
+import numpy as np
 
 from rlpoker.buffer import CircularBuffer, Reservoir
 
 
 def test_circular_buffer_max_len():
-    buffer = CircularBuffer(maxlen=10)
+    buffer = CircularBuffer(maxlen=10, state_dim=2)
 
     for i in range(11):
-        buffer.append(i)
+        buffer.append([i, i], i, float(i), [i + 1, i + 1], i % 2 == 0)
+
+    assert len(buffer) == 10
+    assert set(buffer.actions) == set(range(1, 11))
+
+    states, actions, rewards, next_states, not_terminals = buffer.sample(5)
+
+    assert states.shape == (5, 2)
+    assert next_states.shape == (5, 2)
+    assert set(actions).issubset(set(range(1, 11)))
+    np.testing.assert_array_equal(states[:, 0], actions)
+    np.testing.assert_array_equal(rewards, actions)
+    np.testing.assert_array_equal(next_states[:, 0], actions + 1)
+    np.testing.assert_array_equal(not_terminals, actions % 2)
+
+    buffer.append([11, 11], 11, 11.0, [12, 12], False)
+
+    assert len(buffer) == 10
+    assert set(buffer.actions) == set(range(2, 12))
+
+
+def test_circular_buffer_append_batch():
+    buffer = CircularBuffer(maxlen=10, state_dim=1)
+
+    buffer.append_batch(np.arange(8).reshape(8, 1), np.arange(8), np.zeros(8), np.arange(1, 9).reshape(8, 1),
+                        np.arange(8) == 7)
+    assert len(buffer) == 8
+    np.testing.assert_array_equal(buffer.actions[:8], np.arange(8))
+    np.testing.assert_array_equal(buffer.not_terminals[:8], [1, 1, 1, 1, 1, 1, 1, 0])
+
+    # The batch wraps around, overwriting the oldest transitions.
+    buffer.append_batch(np.arange(8, 13).reshape(5, 1), np.arange(8, 13), np.zeros(5),
+                        np.arange(9, 14).reshape(5, 1), np.zeros(5, dtype=bool))
+    assert len(buffer) == 10
+    assert buffer.pos == 3
+    np.testing.assert_array_equal(buffer.actions, [10, 11, 12, 3, 4, 5, 6, 7, 8, 9])
+    np.testing.assert_array_equal(buffer.states[:, 0], buffer.actions)
 
-    assert buffer.buffer == deque(list(range(1, 11)))
 
-    samples = buffer.sample(5)
+def test_sample_without_replacement():
+    buffer = CircularBuffer(maxlen=10, state_dim=1)
+    buffer.append_batch(np.arange(10).reshape(10, 1), np.arange(10), np.zeros(10), np.zeros((10, 1)),
+                        np.zeros(10, dtype=bool))
 
-    assert set(samples).issubset(set(range(1, 11)))
+    _, actions, _, _, _ = buffer.sample(10, replace=False)
+    assert sorted(actions) == list(range(10))
 
-    assert buffer.buffer == deque(list(range(1, 11)))
 
-    buffer.append(11)
+def test_state_dtype():
+    circular_buffer = CircularBuffer(maxlen=3, state_dim=2, state_dtype=np.float16)
+    circular_buffer.append([0, 1], 0, 1.0, [1, 0], True)
+    states, _, _, next_states, _ = circular_buffer.sample(2)
+    assert states.dtype == np.float16
+    assert next_states.dtype == np.float16
+    np.testing.assert_array_equal(states, [[0, 1], [0, 1]])
 
-    assert buffer.buffer == deque(list(range(2, 12)))
+    reservoir = Reservoir(maxlen=3, state_dim=2, state_dtype=np.uint8)
+    reservoir.append([0, 1], 0)
+    states, _ = reservoir.sample(2)
+    assert states.dtype == np.uint8
+    np.testing.assert_array_equal(states, [[0, 1], [0, 1]])
 
 
 def test_reservoir():
-    buffer = Reservoir(maxlen=5)
+    buffer = Reservoir(maxlen=5, state_dim=1)
 
     for i in range(5):
-        buffer.append(i)
-        assert buffer.buffer == deque(list(range(i+1)))
+        buffer.append([i], i)
+        assert len(buffer) == i + 1
+        np.testing.assert_array_equal(buffer.actions[:i+1], np.arange(i+1))
 
-    buffer.append(5)
+    buffer.append([5], 5)
 
-    samples = buffer.sample(4)
-    assert set(samples).issubset(set(range(6)))
+    states, actions = buffer.sample(4)
+    assert states.shape == (4, 1)
+    assert set(actions).issubset(set(range(6)))
+    np.testing.assert_array_equal(states[:, 0], actions)
 
-    items = set(buffer.buffer)
+    items = set(buffer.actions)
     possible_items = set(range(6))
     assert items.issubset(possible_items)
+
+
+def test_reservoir_append_batch():
+    buffer = Reservoir(maxlen=5, state_dim=1)
+
+    buffer.append_batch(np.arange(3).reshape(3, 1), np.arange(3))
+    assert len(buffer) == 3
+    np.testing.assert_array_equal(buffer.actions[:3], np.arange(3))
+
+    buffer.append_batch(np.arange(3, 100).reshape(97, 1), np.arange(3, 100))
+    assert len(buffer) == 5
+    assert buffer.i == 100
+    assert set(buffer.actions).issubset(set(range(100)))
+    np.testing.assert_array_equal(buffer.states[:, 0], buffer.actions)
+
+
+def test_circular_buffer_sample_while_appending():
+    """Samples on another thread while appending, and checks that the fields of each sampled transition belong
+    to the same transition.
+    """
+    buffer = CircularBuffer(maxlen=100, state_dim=50)
+    buffer.append_batch(np.zeros((100, 50)), np.zeros(100), np.zeros(100), np.zeros((100, 50)),
+                        np.zeros(100, dtype=bool))
+
+    done = threading.Event()
+    mismatches = []
+
+    def sample():
+        while not done.is_set():
+            states, actions, rewards, next_states, _ = buffer.sample(64)
+            if not (np.all(states == actions[:, None]) and np.all(next_states == actions[:, None]) and
+                    np.all(rewards == actions)):
+                mismatches.append(actions)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    for i in range(1, 2000):
+        buffer.append_batch(np.full((30, 50), i), np.full(30, i), np.full(30, i), np.full((30, 50), i),
+                            np.zeros(30, dtype=bool))
+    done.set()
+    sampler.join()
+
+    assert len(mismatches) == 0
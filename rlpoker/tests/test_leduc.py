@@ -200,3 +200,13 @@ def test_compute_betting_round_encoding():
     computed = compute_betting_round_encoding([1, 2, 2, 2, 2], max_raises)
     expected = np.array([1, 0, 0, 0, 0, 1, 0]).astype('float32')
     np.testing.assert_allclose(computed, expected)
+
+
+def test_state_matrix():
+    cards = [Card(1, 2), Card(2, 2), Card(3, 3)]
+    game = LeducNFSP(cards)
+
+    assert game._state_matrix.shape == (len(game._state_vectors), game.state_dim)
+    assert game._state_matrix.dtype == np.float32
+    for info_set_id, row in zip(game._info_set_ids, game._state_matrix):
+        np.testing.assert_array_equal(row, game._state_vectors[info_set_id])
@@ -0,0 +1,50 @@
+import numpy as np
+
+from rlpoker.nfsp import build_transitions
+
+
+def test_build_transitions():
+    states = {1: [np.array([0, 0]), np.array([1, 1]), np.array([2, 2])],
+              2: [np.array([3, 3]), np.array([4, 4])]}
+    actions = {1: [0, 2], 2: [1]}
+    rewards = {1: 3.0, 2: -3.0}
+
+    transitions = build_transitions(states, actions, rewards)
+
+    assert set(transitions.keys()) == {1, 2}
+
+    player_states, player_actions, player_rewards, next_states, terminals = transitions[1]
+    assert player_states.dtype == np.float32
+    assert player_actions.dtype == np.int32
+    assert player_rewards.dtype == np.float32
+    assert next_states.dtype == np.float32
+    assert terminals.dtype == bool
+    np.testing.assert_array_equal(player_states, [[0, 0], [1, 1]])
+    np.testing.assert_array_equal(player_actions, [0, 2])
+    np.testing.assert_array_equal(next_states, [[1, 1], [2, 2]])
+
+    # Only the last transition is terminal, and it gets all the reward.
+    np.testing.assert_array_equal(terminals, [False, True])
+    np.testing.assert_array_equal(player_rewards, [0.0, 3.0])
+
+    player_states, player_actions, player_rewards, next_states, terminals = transitions[2]
+    np.testing.assert_array_equal(player_states, [[3, 3]])
+    np.testing.assert_array_equal(player_actions, [1])
+    np.testing.assert_array_equal(player_rewards, [-3.0])
+    np.testing.assert_array_equal(next_states, [[4, 4]])
+    np.testing.assert_array_equal(terminals, [True])
+
+
+def test_build_transitions_player_never_acts():
+    states = {1: [np.array([0, 0]), np.array([1, 1])], 2: [np.array([1, 1])]}
+    actions = {1: [2], 2: []}
+    rewards = {1: 1.0, 2: -1.0}
+
+    transitions = build_transitions(states, actions, rewards)
+
+    player_states, player_actions, player_rewards, next_states, terminals = transitions[2]
+    assert player_states.shape == (0, 2)
+    assert next_states.shape == (0, 2)
+    assert player_actions.shape == (0,)
+    assert player_rewards.shape == (0,)
+    assert terminals.shape == (0,)
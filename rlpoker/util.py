@@ -4,7 +4,7 @@ import tensorflow as tf
 class TBSummariser:
 
     def __init__(self, scalar_names):
-        self.placeholders = {name: tf.placeholder(dtype=tf.float32, name=name) for name in scalar_names}
+        self.placeholders = {name: tf.placeholder(dtype=tf.float32, shape=[], name=name) for name in scalar_names}
         self.scalars = {name: tf.summary.scalar(name, placeholder) for name, placeholder in self.placeholders.items()}
 
         self.merged = tf.summary.merge([v for v in self.scalars.values()])